@@ -1,188 +1,357 @@
 import re
 import sys
-from random import choices
-from string import ascii_letters
-from os import mkdir, rmdir, remove, replace, environ
-from os.path import join, isfile
-from subprocess import run
-from shutil import copy
-from concurrent.futures import ThreadPoolExecutor
-from ase.io import write
-
-# Files that xtb can create that I may have to remove in the cleanup step
-# Just grepped "file="
-possible_files_xtb = ["charges", "charges2", "charges3", "wbo", "wbo3", "wbofit",
-        "spin", "spin3", "dipole", "dipole2", "energy", "pcharge", "fod",
-        "hfc3"]
-# Same thing but from stda
-possible_files_stda = ["TmPvEcInFo", "qia", "zmint", "xlint", "beta_HRS",
-                       "tday.dat", "tdaz.dat", "qaa", "1st_sf_MO.molden",
-                       "NTOvar", "pij", "molden.input", ".REF", "NTOspin",
-                       "~/.param", "NTOs.html", "yvint", "NTOat", "bmat",
-                       "tdax.dat", "zlint", "qii", "qab", "molden.molden",
-                       "xmint", "zvint", "beta_tensor", "qij", "tda.dat",
-                       "xvint", "NTOao", ".STDA", "tda.exc", "ylint", "ymint",
-                       ".OUT", "amb", "wavelength", "wfn.xtb", "fnorm", "sint",
-                       "2PA-abs", ".ref", "apbmat", "pia", "jmol.spt"]
-default_param_v_text = open(join(__path__[0], "param_v_template.txt")).read()
-default_param_x_text = open(join(__path__[0], "param_x_template.txt")).read()
+import os
+import atexit
+from functools import cache
+from os import environ, cpu_count, scandir, remove, symlink
+from os.path import join
+from multiprocessing import Value
+from multiprocessing.util import Finalize
+from subprocess import run, Popen, PIPE, CalledProcessError
+from tempfile import mkdtemp
+from shutil import copy, move, rmtree
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+@cache
+def _load_template(name):
+    '''Read one of the package's parameter file templates. Cached so the file
+    is only read once, and lazy so importing the module does no file I/O for
+    users who never run xtb'''
+    with open(join(__path__[0], name)) as template_file:
+        return template_file.read()
+
+def _xyz_text(mol):
+    '''Format an ASE molecule as xyz file text directly, skipping ASE's
+    generic format dispatch, which is slow enough to matter when running
+    thousands of small molecules'''
+    symbols = mol.get_chemical_symbols()
+    positions = mol.get_positions()
+    lines = "\n".join(f"{symbol} {x:.10f} {y:.10f} {z:.10f}"
+                      for symbol, (x, y, z) in zip(symbols, positions))
+    return f"{len(symbols)}\n\n{lines}\n"
+
+def _fast_write_xyz(path, mol):
+    '''Write an ASE molecule as an xyz file, formatted by _xyz_text'''
+    open(path, "w").write(_xyz_text(mol))
+
+def _clear_scratch(dir_name, keep = ()):
+    '''Remove every file in a reusable scratch directory, except any whose
+    names are in keep, leaving the directory itself in place for the next
+    run. Uses scandir so there's a single directory read and no per-file stat
+    calls'''
+    for entry in scandir(dir_name):
+        if entry.name not in keep and entry.is_file():
+            remove(entry.path)
 
 def save_wavefunction(mol, outpath,
-                      param_x_text = default_param_x_text,
-                      param_v_text = default_param_v_text,
-                      nthreads = None):
+                      param_x_text = None,
+                      param_v_text = None,
+                      nthreads = None,
+                      cwd = None):
     '''Given an ASE molecule, save an XTB wavefunction to the given directory,
-    computed using xtb4stda. Also returns the xtb4stda log as a string.'''
-
-    # Create temporary directory with a random name
-    temp_dir_name = "tempdir_" + "".join(choices(ascii_letters, k = 80))
-    mkdir(temp_dir_name)
-
-    # Save parameter files
-    param_x_path = join(temp_dir_name, "param_x.xtb")
-    open(param_x_path, "w").write(param_x_text)
-    param_v_path = join(temp_dir_name, "param_v.xtb")
-    open(param_v_path, "w").write(param_v_text)
-
-    # Save xyz file
-    xyz_path = join(temp_dir_name, "mol.xyz")
-    write(xyz_path, mol)
-
-    # Set environment variables
-    env = environ.copy()
-    if nthreads is not None:
-        env["OMP_NUM_THREADS"] = str(nthreads)
-        env["MKL_NUM_THREADS"] = str(nthreads)
-    # Set working directory to target folder and run
-    xtb4stda_run = run(["xtb4stda", "mol.xyz", "-parx", "param_x.xtb", "-parv",
-    "param_v.xtb"], capture_output = True, text = True, cwd = temp_dir_name,
-    check = True, env = env)
-    out_text = xtb4stda_run.stdout
-
-    # Copy wavefunction file to target path
-    temp_wavefunction_path = join(temp_dir_name, "wfn.xtb")
-    replace(temp_wavefunction_path, outpath)
-
-    # Cleanup
-    for temp_file_name in possible_files_xtb:
-        temp_file_path = join(temp_dir_name, temp_file_name)
-        if isfile(temp_file_path):
-            remove(temp_file_path)
-    remove(xyz_path)
-    remove(param_x_path)
-    remove(param_v_path)
-    # After moving the wavefuntion file and deleting the molecule and the extra
-    # files generated by xtb4stda, the directory should be empty, so there
-    # should be no error from rmdir
-    rmdir(temp_dir_name)
+    computed using xtb4stda. Also returns the xtb4stda log as a string. If cwd
+    is given, that directory is used for scratch files and emptied (but kept)
+    afterwards, instead of creating and destroying a temporary directory.'''
+
+    # Fall back to the package's parameter templates, loaded lazily
+    if param_x_text is None:
+        param_x_text = _load_template("param_x_template.txt")
+    if param_v_text is None:
+        param_v_text = _load_template("param_v_template.txt")
+
+    # Create temporary directory on local scratch, so that all of xtb4stda's
+    # intermediate file I/O stays off a possibly networked filesystem. The
+    # scratch location can be overridden with the XTB_STDA_TMPDIR environment
+    # variable
+    if cwd is None:
+        temp_dir_name = mkdtemp(prefix = "xtb_stda_",
+                                dir = environ.get("XTB_STDA_TMPDIR"))
+    else:
+        temp_dir_name = cwd
+    try:
+        # Save parameter files
+        param_x_path = join(temp_dir_name, "param_x.xtb")
+        open(param_x_path, "w").write(param_x_text)
+        param_v_path = join(temp_dir_name, "param_v.xtb")
+        open(param_v_path, "w").write(param_v_text)
+
+        # Save xyz file
+        xyz_path = join(temp_dir_name, "mol.xyz")
+        _fast_write_xyz(xyz_path, mol)
+
+        # Only build a modified environment if a thread count was requested;
+        # env = None makes the subprocess inherit the parent environment with
+        # no copying
+        if nthreads is None:
+            env = None
+        else:
+            env = {**environ, "OMP_NUM_THREADS": str(nthreads),
+                   "MKL_NUM_THREADS": str(nthreads)}
+        # Set working directory to target folder and run
+        xtb4stda_run = run(["xtb4stda", "mol.xyz", "-parx", "param_x.xtb",
+        "-parv", "param_v.xtb"], capture_output = True, text = True, cwd =
+        temp_dir_name, check = True, env = env)
+        out_text = xtb4stda_run.stdout
+
+        # Copy wavefunction file to target path. Using move rather than
+        # replace, since the scratch directory may be on a different
+        # filesystem than the target path
+        temp_wavefunction_path = join(temp_dir_name, "wfn.xtb")
+        move(temp_wavefunction_path, outpath)
+    finally:
+        # Remove whatever extra files xtb4stda left behind, even if the run
+        # crashed. A caller-provided scratch directory is kept for reuse
+        if cwd is None:
+            rmtree(temp_dir_name, ignore_errors = True)
+        else:
+            _clear_scratch(temp_dir_name)
 
     return out_text
 
 
 def wavefunction_stda(xtb_path, dat_path = None, triplet = False, nthreads =
-                      None, energy_threshold = None):
+                      None, energy_threshold = None, cwd = None):
     '''Given a path to an XTB wavefunction created by xtb4stda, run stda and
-    return the output as a string'''
-
-    # Create temporary directory to store wavefunction.  This avoids conflicts
-    # with other instances, since stda requires a specific name for the file
-    temp_dir_name = "tempdir_" + "".join(choices(ascii_letters, k = 80))
-    mkdir(temp_dir_name)
-
-    # Copy the wavefunction file into the directory, with the name that the
-    # stda program expects
-    copied_xtb_path = join(temp_dir_name, "wfn.xtb")
-    copy(xtb_path, copied_xtb_path)
-
-    # Add extra flags to the subprocess command based on the optional function
-    # parameters
-    extra_flags = []
-    if triplet:
-        extra_flags.append("-t")
-    if energy_threshold is not None:
-        extra_flags.append("-e")
-        extra_flags.append(str(energy_threshold))
-
-    # Set environment variables
-    env = environ.copy()
-    if nthreads is not None:
-        env["OMP_NUM_THREADS"] = str(nthreads)
-        env["MKL_NUM_THREADS"] = str(nthreads)
-
-    # Run stda
-    stda_run = run(["stda", "-xtb"] + extra_flags, capture_output = True, text
-    = True, cwd = temp_dir_name, check = True, env = env)
-
-    # Retrieve text printed by the stda program
-    out_text = stda_run.stdout
-
-    # If we're keeping the dat file in order to make a spectrum with g_spec,
-    # copy it to the given path
-    if dat_path is not None:
-        copy(join(temp_dir_name, "tda.dat"), dat_path)
-
-    # Cleanup
-    remove(copied_xtb_path)
-    for temp_file_name in possible_files_stda:
-        temp_file_path = join(temp_dir_name, temp_file_name)
-        if isfile(temp_file_path):
-            remove(temp_file_path)
-    # After removing the input file and every possible output file, should be
-    # clear to remove the directory
-    rmdir(temp_dir_name)
+    return the output as a string. If cwd is given, that directory is used for
+    scratch files and emptied (but kept) afterwards, instead of creating and
+    destroying a temporary directory.'''
+
+    # Create temporary directory on local scratch to store the wavefunction.
+    # This avoids conflicts with other instances, since stda requires a
+    # specific name for the file, and keeps stda's many scratch files off a
+    # possibly networked filesystem
+    if cwd is None:
+        temp_dir_name = mkdtemp(prefix = "xtb_stda_",
+                                dir = environ.get("XTB_STDA_TMPDIR"))
+    else:
+        temp_dir_name = cwd
+    try:
+        # Copy the wavefunction file into the directory, with the name that
+        # the stda program expects
+        copied_xtb_path = join(temp_dir_name, "wfn.xtb")
+        copy(xtb_path, copied_xtb_path)
+
+        # Add extra flags to the subprocess command based on the optional
+        # function parameters
+        extra_flags = []
+        if triplet:
+            extra_flags.append("-t")
+        if energy_threshold is not None:
+            extra_flags.append("-e")
+            extra_flags.append(str(energy_threshold))
+
+        # Only build a modified environment if a thread count was requested;
+        # env = None makes the subprocess inherit the parent environment with
+        # no copying
+        if nthreads is None:
+            env = None
+        else:
+            env = {**environ, "OMP_NUM_THREADS": str(nthreads),
+                   "MKL_NUM_THREADS": str(nthreads)}
+
+        # Run stda
+        stda_run = run(["stda", "-xtb"] + extra_flags, capture_output = True,
+        text = True, cwd = temp_dir_name, check = True, env = env)
+
+        # Retrieve text printed by the stda program
+        out_text = stda_run.stdout
+
+        # If we're keeping the dat file in order to make a spectrum with
+        # g_spec, copy it to the given path
+        if dat_path is not None:
+            copy(join(temp_dir_name, "tda.dat"), dat_path)
+    finally:
+        # Remove the input file and every output file stda created, even if
+        # the run crashed. A caller-provided scratch directory is kept for
+        # reuse
+        if cwd is None:
+            rmtree(temp_dir_name, ignore_errors = True)
+        else:
+            _clear_scratch(temp_dir_name)
 
     return out_text
 
-# Copied from my script iridium_xtb_test/log2energy.py
-def log2energy(stda_log):
-    '''From an stda log as a string, extract and return the excitation energy
-    to the lowest excited state as a number, in eV'''
+# Based on observation (not inspection of the code) it looks like stda always
+# prints three digits after the decimal point. And with sufficiently small
+# energies, there's not necessarily a space between the energy and the
+# wavelength. Therefore the regex can't use * at the end, it has to actually
+# count digits. Compiled once here rather than per line
+_energy_re = re.compile(r"\s*1\s*([0-9]*\.[0-9][0-9]?[0-9]?)")
+# Section heading preceding the table that has the energy in it
+_energy_header = "excitation energies, transition moments and TDA amplitudes"
+
+def log2energy_stream(lines):
+    '''From an iterator over lines of an stda log, extract and return the
+    excitation energy to the lowest excited state as a number, in eV. Taking
+    an iterator means the lines can come straight from a running stda process,
+    without waiting for it to finish or buffering the whole log'''
     right_part = False
-    for line in stda_log.split("\n"):
-        # Based on observation (not inspection of the code) it looks like it
-        # always prints three digits after the decimal point. And with
-        # sufficiently small energies, there's not necessarily a space between
-        # the energy and the wavelength. Therefore the regex can't use * at the
-        # end, it has to actually count digits
-        match_string = r"\s*1\s*([0-9]*\.[0-9][0-9]?[0-9]?)"
+    for line in lines:
         # Section heading
-        if "excitation energies, transition moments and TDA amplitudes" in line:
+        if _energy_header in line:
             right_part = True
         if line.strip() == "":
             right_part = False
-        energy_match = re.match(match_string, line)
-        if right_part and energy_match is not None:
-            return float(energy_match.group(1))
+        # Don't bother running the regex on lines outside the right section
+        if right_part:
+            energy_match = _energy_re.match(line)
+            if energy_match is not None:
+                return float(energy_match.group(1))
+
+# Copied from my script iridium_xtb_test/log2energy.py
+def log2energy(stda_log):
+    '''From an stda log as a string, extract and return the excitation energy
+    to the lowest excited state as a number, in eV'''
+    return log2energy_stream(stda_log.splitlines())
+
+def _run_pipeline(mol,
+                  # xtb4stda arguments
+                  param_x_text = None,
+                  param_v_text = None,
+                  nthreads = None,
+                  # stda arguments
+                  triplet = False,
+                  energy_threshold = None,
+                  cwd = None):
+    '''Run xtb4stda and then stda in a single temporary directory, returning
+    the excitation energy to the lowest excited state in eV. Since xtb4stda
+    writes wfn.xtb under exactly the name stda expects, running both in the
+    same directory means the wavefunction file never has to be copied
+    anywhere. The stda output is parsed as it prints, and stda is terminated
+    as soon as the energy shows up, rather than waiting for the rest of the
+    log. If cwd is given, that directory is used for scratch files and
+    emptied (but kept) afterwards, as with the pool workers' per-process
+    scratch directories'''
+    # Fall back to the package's parameter templates, loaded lazily
+    if param_x_text is None:
+        param_x_text = _load_template("param_x_template.txt")
+    if param_v_text is None:
+        param_v_text = _load_template("param_v_template.txt")
+    if cwd is None:
+        temp_dir_name = mkdtemp(prefix = "xtb_stda_",
+                                dir = environ.get("XTB_STDA_TMPDIR"))
+    else:
+        # Each molecule gets its own subdirectory of the worker's scratch
+        # directory, so deleting it can be handed off to the background
+        # cleanup thread without racing the next molecule's run
+        temp_dir_name = mkdtemp(prefix = "mol_", dir = cwd)
+    # Whether the worker's scratch directory already contains these exact
+    # parameter files, written once by _worker_init. Compared by value rather
+    # than identity, since the texts arrive in the worker by pickling and so
+    # aren't the same objects that were passed to the initializer
+    global _worker_param_x_text, _worker_param_v_text
+    params_cached = (cwd is not None
+                     and param_x_text == _worker_param_x_text
+                     and param_v_text == _worker_param_v_text)
+    try:
+        # Save parameter files, unless the worker already has them. In a
+        # worker, they go in the worker's directory itself, above the
+        # per-molecule subdirectories, so later molecules can reuse them
+        param_dir = temp_dir_name if cwd is None else cwd
+        param_x_path = join(param_dir, "param_x.xtb")
+        param_v_path = join(param_dir, "param_v.xtb")
+        if not params_cached:
+            open(param_x_path, "w").write(param_x_text)
+            open(param_v_path, "w").write(param_v_text)
+            if cwd is not None:
+                # Record the newly written files as the worker's cached
+                # copies, so the next molecule with the same parameters can
+                # reuse them
+                _worker_param_x_text = param_x_text
+                _worker_param_v_text = param_v_text
+
+        # Rather than writing the geometry to disk just for xtb4stda to read
+        # it back, feed it on standard input. xtb4stda picks its parser based
+        # on the file extension, so the trick is a mol.xyz symlink pointing
+        # at /dev/stdin
+        xyz_path = join(temp_dir_name, "mol.xyz")
+        symlink("/dev/stdin", xyz_path)
+
+        # Environment for the two subprocesses. The workers always run with
+        # one thread, so they reuse the dict built once in _worker_init
+        # rather than copying the whole environment for every molecule. With
+        # no thread count requested, env = None inherits the parent
+        # environment with no copying at all
+        if nthreads is None:
+            env = None
+        elif cwd is not None and nthreads == 1:
+            env = _worker_env
+        else:
+            env = {**environ, "OMP_NUM_THREADS": str(nthreads),
+                   "MKL_NUM_THREADS": str(nthreads)}
+
+        # Run xtb4stda, leaving wfn.xtb in place for stda
+        run(["xtb4stda", "mol.xyz", "-parx", param_x_path, "-parv",
+        param_v_path], input = _xyz_text(mol), capture_output = True, text =
+        True, cwd = temp_dir_name, check = True, env = env)
+
+        # Add extra flags to the stda command based on the optional function
+        # parameters
+        extra_flags = []
+        if triplet:
+            extra_flags.append("-t")
+        if energy_threshold is not None:
+            extra_flags.append("-e")
+            extra_flags.append(str(energy_threshold))
+
+        # Run stda in the same directory, where the wavefunction already is,
+        # parsing its output as it arrives instead of buffering the whole
+        # log. Its diagnostics go to a file in the scratch directory rather
+        # than a second pipe, which could fill up and deadlock while stdout
+        # is being read; the file is only read back if the run fails
+        stderr_path = join(temp_dir_name, "stda_stderr.txt")
+        with open(stderr_path, "w") as stderr_file:
+            stda_proc = Popen(["stda", "-xtb"] + extra_flags, stdout = PIPE,
+            stderr = stderr_file, text = True, cwd = temp_dir_name, env = env)
+            energy = log2energy_stream(iter(stda_proc.stdout.readline, ""))
+            if energy is not None:
+                # Got the energy, so no need to let stda print the rest of
+                # the log
+                stda_proc.terminate()
+                stda_proc.wait()
+            else:
+                # Reached the end of the output without finding an energy.
+                # Only now does it matter whether stda actually failed
+                returncode = stda_proc.wait()
+                if returncode != 0:
+                    with open(stderr_path) as diagnostics_file:
+                        stda_stderr = diagnostics_file.read()
+                    raise CalledProcessError(returncode, stda_proc.args,
+                                             stderr = stda_stderr)
+            stda_proc.stdout.close()
+
+        return energy
+    finally:
+        # Remove everything the two programs left behind, even if one of the
+        # runs crashed. In a worker, the deletion is queued on the cleanup
+        # thread so the next molecule can start without waiting for the
+        # unlinks; the worker's own directory and its cached parameter files
+        # are untouched
+        if cwd is None:
+            rmtree(temp_dir_name, ignore_errors = True)
+        else:
+            _cleanup_pool.submit(rmtree, temp_dir_name, ignore_errors = True)
 
 def mol2energy(mol,
                # xtb4stda arguments
-               param_x_text = default_param_x_text,
-               param_v_text = default_param_v_text,
+               param_x_text = None,
+               param_v_text = None,
                nthreads = None,
                # stda arguments
                triplet = False,
                energy_threshold = None):
     '''Convenience wrapper function that does xtb, stda, and extracts an energy
     from an ASE molecule, returning the energy in eV as a float'''
-    # Name of temporary wavefunction file
-    temp_file_name = "tmp_wfn_" + "".join(choices(ascii_letters, k = 80)) + ".xtb"
-    save_wavefunction(mol, temp_file_name, param_x_text = param_x_text,
-                      param_v_text = param_v_text, nthreads = nthreads)
-
-    # Log from stda
-    stda_log = wavefunction_stda(temp_file_name, triplet = triplet,
-                                 energy_threshold = energy_threshold,
-                                 nthreads = nthreads)
-    remove(temp_file_name)
-
-    # Energy
-    return log2energy(stda_log)
+    return _run_pipeline(mol, param_x_text = param_x_text,
+                         param_v_text = param_v_text,
+                         nthreads = nthreads, triplet = triplet,
+                         energy_threshold = energy_threshold)
 
 class Mol2EnergyClosure:
     def __init__(self, 
                # xtb4stda arguments
-               param_x_text = default_param_x_text,
-               param_v_text = default_param_v_text,
+               param_x_text = None,
+               param_v_text = None,
                # stda arguments
                triplet = False,
                energy_threshold = None):
@@ -192,30 +361,138 @@ class Mol2EnergyClosure:
         self.energy_threshold = energy_threshold
     
     def __call__(self, mol):
-        return mol2energy(mol, param_x_text = self.param_x_text, param_v_text =
-                          self.param_v_text, triplet = self.triplet, nthreads =
-                          1, energy_threshold = self.energy_threshold)
+        return _run_pipeline(mol, param_x_text = self.param_x_text,
+                             param_v_text = self.param_v_text, triplet =
+                             self.triplet, nthreads = 1, energy_threshold =
+                             self.energy_threshold, cwd = _worker_dir)
+
+# Scratch directory for a pool worker process, created once per worker by
+# _worker_init and reused for every molecule that worker handles, so each
+# molecule doesn't pay for a mkdir and rmdir of its own
+_worker_dir = None
+# The parameter file text already written into the worker's scratch
+# directory, so identical parameters don't get rewritten for every molecule
+_worker_param_x_text = None
+_worker_param_v_text = None
+# Single background thread per worker process that deletes finished
+# molecules' scratch subdirectories, keeping the unlinks off the critical
+# path between one molecule and the next
+_cleanup_pool = None
+# Environment dict for the worker's subprocesses, built once since the pool
+# always runs them single threaded
+_worker_env = None
+# Shared counter handing each worker a distinct id, since the pool doesn't
+# number its workers itself. Used to pin each worker to its own core
+_worker_counter = Value("i", 0)
+
+def _worker_init(param_x_text = None, param_v_text = None):
+    '''Initializer run once in each pool worker process: create the worker's
+    persistent scratch directory, arrange for it to be removed when the worker
+    exits, start the background cleanup thread, and write the parameter files
+    into the directory once, since they're the same for every molecule in a
+    batch'''
+    global _worker_dir, _worker_param_x_text, _worker_param_v_text
+    global _cleanup_pool, _worker_env
+    _worker_dir = mkdtemp(prefix = "xtb_worker_",
+                          dir = environ.get("XTB_STDA_TMPDIR"))
+    _cleanup_pool = ThreadPoolExecutor(max_workers = 1)
+    # OMP_PROC_BIND makes the xtb subprocesses stay on the core this worker
+    # is pinned to below, instead of letting the OS migrate them
+    _worker_env = {**environ, "OMP_NUM_THREADS": "1",
+                   "MKL_NUM_THREADS": "1", "OMP_PROC_BIND": "true"}
+    # Pin this worker to its own core, so successive molecules handled by
+    # the worker find the caches still warm. Setting OMP_NUM_THREADS alone
+    # doesn't stop the OS from migrating the process between cores. The core
+    # is chosen from the set we're actually allowed to run on, which on a
+    # cluster may be smaller than the machine. Affinity calls only exist on
+    # Linux; elsewhere the worker just runs unpinned
+    if hasattr(os, "sched_setaffinity"):
+        with _worker_counter.get_lock():
+            worker_id = _worker_counter.value
+            _worker_counter.value += 1
+        try:
+            allowed_cores = sorted(os.sched_getaffinity(0))
+            os.sched_setaffinity(
+                    0, {allowed_cores[worker_id % len(allowed_cores)]})
+        except OSError:
+            # No harm in running unpinned if the affinity call isn't
+            # permitted
+            pass
+    # Registered through multiprocessing's own finalizer machinery rather
+    # than atexit, since pool workers exit through os._exit, which skips
+    # atexit handlers entirely but does run these. Higher priorities run
+    # first, so the cleanup thread finishes its queued deletions before the
+    # worker directory itself is removed
+    Finalize(None, rmtree, args = (_worker_dir,),
+             kwargs = {"ignore_errors": True}, exitpriority = 10)
+    Finalize(None, _cleanup_pool.shutdown, kwargs = {"wait": True},
+             exitpriority = 20)
+    if param_x_text is not None and param_v_text is not None:
+        open(join(_worker_dir, "param_x.xtb"), "w").write(param_x_text)
+        open(join(_worker_dir, "param_v.xtb"), "w").write(param_v_text)
+        _worker_param_x_text = param_x_text
+        _worker_param_v_text = param_v_text
+
+# Persistent pool of worker processes, created lazily on the first call to
+# mols2energy and reused across calls, so repeated batches don't pay the
+# fork/spawn cost every time
+_pool = None
+
+def _get_pool(param_x_text, param_v_text, max_workers):
+    global _pool
+    # Since the pool outlives any one call, a different requested worker
+    # count means the old pool has to be replaced, not silently reused
+    if _pool is not None and _pool._max_workers != max_workers:
+        _pool.shutdown(wait = True)
+        _pool = None
+    if _pool is None:
+        _pool = ProcessPoolExecutor(max_workers = max_workers,
+                                    initializer = _worker_init,
+                                    initargs = (param_x_text, param_v_text))
+        # Make sure the workers get shut down when the interpreter exits
+        atexit.register(_pool.shutdown)
+    return _pool
 
 def mols2energy(mols,
                # xtb4stda arguments
-               param_x_text = default_param_x_text,
-               param_v_text = default_param_v_text,
+               param_x_text = None,
+               param_v_text = None,
                # stda arguments
                triplet = False,
-               energy_threshold = None):
+               energy_threshold = None,
+               # Parallelism
+               max_workers = None):
     '''Given a list of ASE molecules, run xtb-stda on them in parallel, and
-    return a list of excitation energies'''
-    #closure = Mol2EnergyClosure(
-    #           param_x_text = param_x_text,
-    #           param_v_text = param_v_text,
-    #           triplet = triplet,
-    #           energy_threshold = energy_threshold)
-    closure = lambda mol: mol2energy(mol,
+    return a list of excitation energies. The worker pool persists between
+    calls; max_workers sets its size, defaulting to the number of CPUs, and
+    passing a different value on a later call replaces the pool'''
+    if len(mols) == 0:
+        return []
+    # Fall back to the package's parameter templates, loaded lazily. Resolved
+    # here so the worker initializer gets the actual text
+    if param_x_text is None:
+        param_x_text = _load_template("param_x_template.txt")
+    if param_v_text is None:
+        param_v_text = _load_template("param_v_template.txt")
+    closure = Mol2EnergyClosure(
                param_x_text = param_x_text,
                param_v_text = param_v_text,
                triplet = triplet,
                energy_threshold = energy_threshold)
-    with ThreadPoolExecutor() as pool:
-        # Without calling "list", I get a generator
-        energies = list(pool.map(closure, mols))
+    # With a single molecule there's nothing to parallelize, so skip the pool
+    # and its pickling overhead, and don't spawn workers just to leave them
+    # idle
+    if len(mols) == 1:
+        return [closure(mols[0])]
+    # The pool is sized to the machine rather than to this batch, since it
+    # sticks around for later calls and idle workers cost nothing once
+    # spawned
+    if max_workers is None:
+        max_workers = cpu_count()
+    pool = _get_pool(param_x_text, param_v_text, max_workers)
+    # Batch the molecules rather than sending them to the workers one at a
+    # time, so each molecule doesn't pay its own interprocess round trip
+    chunksize = max(1, len(mols) // (4 * pool._max_workers))
+    # Without calling "list", I get a generator
+    energies = list(pool.map(closure, mols, chunksize = chunksize))
     return energies